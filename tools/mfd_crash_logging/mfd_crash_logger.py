@@ -1,6 +1,43 @@
 from tools.ssh import SSHHandler
+from tools.ssh.ssh_handler import ExecuteCommandError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
 import os
-from time import sleep
+import posixpath
+import tarfile
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+# Directory on the MFD that the crash log script writes each set of crash logs into
+CRASH_LOG_DIRECTORY = "/mnt/tmp/crash_logs"
+
+# Printed with the exit status in place of the crash log listing when the crash log script fails
+SCRIPT_FAILED_MARKER = "__SCRIPT_FAILED__:"
+
+# Replaces characters that can't be used in local crash log file names, colons aren't allowed on Windows
+_PATHSAFE = str.maketrans({":": "-"})
+
+# Upper bound on the number of MFDs processed at once
+MAX_PARALLEL_HOSTS = 8
+
+# Local directories already created by this process, so repeat calls from each host skip the filesystem
+_created_directories = set()
+_created_directories_lock = threading.Lock()
+
+
+def _make_directory(path):
+    # Creates the directory if it doesn't already exist, safe to call from several worker threads at once
+    with _created_directories_lock:
+        if path in _created_directories:
+            return
+        existed = os.path.isdir(path)
+        os.makedirs(path, exist_ok=True)
+        _created_directories.add(path)
+
+    if not existed:
+        log.info("Created %s directory", path)
 
 
 class MFDCrashLogs:
@@ -12,132 +49,148 @@ class MFDCrashLogs:
         self.local_path = local_crash_log_path
         self.host = host
 
-        if not os.path.exists(self.local_path):
-            print(f"Creating crash log directory {self.local_path}")
-            os.mkdir(self.local_path)
-            print("Crash log directory created")
+        _make_directory(self.local_path)
 
         if host["Model"] == "Axiom":
             self.remote_path = "/data/raymarine"
         elif host["Model"] == "Axiom 2":
             self.remote_path = "/data/vendor/raymarine"
         else:
-            print("Unknown model, Cant set script path")
+            log.error("Unknown model, Cant set script path")
     #         todo custom exception here
 
     def transfer_crash_log_script(self):
-        print("Transferring shell script")
+        log.debug("Transferring shell script")
         self.ssh_handler.scp_connect()
 
-
-        connection, return_code = self.ssh_handler.push_file(self.script_path, self.remote_path)
-        if return_code == 1011:
-            print(f"Pushed {self.script_path} to {self.remote_path}")
-        else:
-            print("An error occurred whilst pushing shell script to remote")
-            return "Couldn't Push Shell Script"
-
-        print("Transferred shell script")
-
-        sleep(2)
+        # push_file only returns once the remote has acknowledged the whole file, so the script can be executed
+        # straight away. A failed push raises SCPTransferError
+        self.ssh_handler.push_file(self.script_path, self.remote_path)
+        log.info("Pushed %s to %s", self.script_path, self.remote_path)
 
     def execute_crash_log_script(self):
         _full_remote_path = f"{self.remote_path}/{self.crash_script}"
 
-        # Set permissions for shell script
-        print("Setting Permissions for extract_crashes.sh")
-        _set_permissions = f"chmod +x {_full_remote_path}"
-
-        # todo I think this previously needed to have the output caught, Test this
-        print(f"Setting Permissions for {self.remote_path}/{self.crash_script}")
-        self.ssh_handler.execute_command(_set_permissions)
-
-        # Execute shell script
-        print(f"Executing shell script at {self.remote_path}/{self.crash_script}")
-        _execute_script = f".{_full_remote_path}"
+        # Set permissions for the shell script, execute it and list the crash logs it produced in a single SSH call.
+        # The call only returns once the script has finished, so there is no need to wait for it. If the script
+        # fails its exit status is printed after SCRIPT_FAILED_MARKER instead, otherwise the exit status is find's and
+        # a non-zero exit status means there is no crash log directory to pull from
+        log.debug("Setting Permissions for and executing shell script at %s, then checking for crashlog file",
+                  _full_remote_path)
+        _execute_script = (f"chmod +x {_full_remote_path} && {_full_remote_path} > /dev/null 2>&1\n"
+                           f"script_status=$?\n"
+                           f"if [ \"$script_status\" -ne 0 ]; then\n"
+                           f"    echo \"{SCRIPT_FAILED_MARKER}$script_status\"\n"
+                           f"else\n"
+                           f"    find {CRASH_LOG_DIRECTORY} -mindepth 2 -maxdepth 2 -type f -print 2>/dev/null\n"
+                           f"fi")
 
-        # todo I think this previously needed to have the output caught, Test this
-        self.ssh_handler.execute_command(_execute_script)
+        _output, _exit_status = self.ssh_handler.execute_script(_execute_script)
 
-        sleep(5)
+        if _output and _output[-1].startswith(SCRIPT_FAILED_MARKER):
+            _script_status = _output[-1][len(SCRIPT_FAILED_MARKER):]
+            log.error("Crash log script %s failed on %s with exit status %s", _full_remote_path,
+                      self.host['hostname'], _script_status)
+            raise ExecuteCommandError(f"Crash log script failed with exit status {_script_status}")
 
-    def pull_crash_logs(self):
-        _check_crash_logs = "ls /mnt/tmp/crash_logs/"
+        log.debug("Crash log script finished, crash log listing exit status %s", _exit_status)
 
-        print("Checking for crashlog file")
-        # todo if command fails to execute we need to catch it here
-        _output = self.ssh_handler.execute_command_with_output(_check_crash_logs)
+        return _output, _exit_status
 
-        _output = _output[0]
-
-        print(f"{_output} Checking for crashlog file")
+    def pull_crash_logs(self, crash_log_listing, exit_status):
+        # crash_log_listing and exit_status are returned by execute_crash_log_script, the listing has one
+        # /mnt/tmp/crash_logs/<log name>/<file> path per crash log file
 
         # If crash log file is not present, print message and go through loop again
         # If crash log file is present, get the name of the file and use scp tunnel to transfer it to local machine
-        if _output == "ls: /mnt/tmp/crash_logs/: No such file or directory":
-            print(f"No crashes detected for {self.host['hostname']}")
+        if exit_status != 0:
+            log.info("No crashes detected for %s", self.host['hostname'])
             # todo am i still tracking this?? This line only works for one host pretty sure
             hosts_without_crash_logs = [self.host]
 
-            print(f"Closing SSH connections to {self.host['hostname']}")
-            self.ssh_handler.disconnect_all()
-
-        elif _output != "ls: /mnt/tmp/crash_logs/: No such file or directory":
-            _log_name = _output
-            _remote_directory = f"./mnt/tmp/crash_logs/{_log_name}"
-            _find_crash_logs_file = f"ls {_remote_directory}"
-
-            print(f"Crash logs for {self.host['hostname']} located at {_remote_directory}")
-            print(f"Checking for crash logs in {_remote_directory}")
-            _output, _exit_status = self.ssh_handler.execute_command_with_exit_status(_find_crash_logs_file)
-
-            if _exit_status == 0:
-                # todo did i break this "output"?
-                print(f"Crash logs found in {_remote_directory}: {_output[0]}")
-                # todo this falls over if the directory already exists
-                # Create directory for the system if it doesn't exist
-                # this is no longer needed as we are removing the concepts of systems
-                if not os.path.exists(f"{app.config['CRASH_LOG_DIR']}/{host['System']}"):
-                    os.mkdir(f"{app.config['CRASH_LOG_DIR']}/{host['System']}")
-                    print(f"Created {app.config['CRASH_LOG_DIR']}/{host['System']} directory for " + host["System"])
-
-                # Create directory for crash logs using MFD Name and MFD Serial Number
-                log_file_name = (f"{app.config['CRASH_LOG_DIR']}/{host['System']}/{host['Name']}"
-                                 f"_{host['SerialNumber']}")
-                log_file_name = log_file_name.replace(" ", "_")
-                os.mkdir(log_file_name)
-                print(
-                    f"Created {log_file_name} directory")
-
-                save_useful_host_info(host, log_file_name, ssh_handler)
-
-                # todo did i break this by moving into the if statement from past the else?
-                if output:
-                    for file in output:
-                        file = file.replace("\n", "").replace("\r", "")
-                        remote_file = f"{remote_directory}/{file}"
-                        print(remote_file)
-                        local_file = log_file_name + "/" + file
-                        local_file = local_file.replace(":", "-")
-                        print(local_file)
-
-                        print("Getting Logs")
-                        connection, return_code = ssh_handler.pull_file(local_file, remote_file)
-                        if return_code == 1013:
-                            print(f"Pulled {remote_path} to {local_path}")
-                        else:
-                            print("An error occurred whilst pulling file from remote")
-                            return "Couldn't Pull Logs"
-                else:
-                    print("No files in directory")
+        elif not crash_log_listing:
+            log.info("No crash log files found for %s", self.host['hostname'])
 
+        else:
+            # find lists files in directory order, sort the listing so the same crash log directory is picked each
+            # time
+            crash_log_listing = sorted(crash_log_listing)
+
+            # The crash log directory name is the first path component below CRASH_LOG_DIRECTORY
+            _log_names = sorted({posixpath.relpath(_file, CRASH_LOG_DIRECTORY).split("/")[0]
+                                 for _file in crash_log_listing})
+            _log_name = _log_names[0]
+            _remote_directory = f"{CRASH_LOG_DIRECTORY}/{_log_name}"
+            if len(_log_names) > 1:
+                log.warning("%s has %s crash log directories, only pulling %s and ignoring %s",
+                            self.host['hostname'], len(_log_names), _log_name, _log_names[1:])
+            _crash_log_files = [posixpath.basename(_file) for _file in crash_log_listing
+                                if posixpath.dirname(_file) == _remote_directory]
+
+            log.info("%s crash logs for %s located at %s: %s", len(_crash_log_files), self.host['hostname'],
+                     _remote_directory, _crash_log_files)
+
+            # Create directory for crash logs using MFD Name and MFD Serial Number
+            log_file_name = f"{self.local_path}/{self.host['Name']}_{self.host['SerialNumber']}"
+            log_file_name = log_file_name.replace(" ", "_")
+            _make_directory(log_file_name)
+
+            # todo save_useful_host_info(host, log_file_name, ssh_handler)
+
+            # Stream the whole crash log directory back as a single tar archive rather than pulling each file over
+            # its own SCP transfer
+            log.debug("Getting Logs")
+            _archive_crash_logs = f"tar -C {_remote_directory} -cf - ."
+            _stdout = self.ssh_handler.execute_command_with_stream(_archive_crash_logs)
+
+            try:
+                with tarfile.open(fileobj=_stdout, mode="r|") as _archive:
+                    for _member in _archive:
+                        _member.name = _member.name.translate(_PATHSAFE)
+                        if _member.islnk() or _member.issym():
+                            _member.linkname = _member.linkname.translate(_PATHSAFE)
+                        # The archive comes from the MFD, the data filter refuses absolute paths, paths outside
+                        # log_file_name and links pointing out of it
+                        _archive.extract(_member, log_file_name, filter="data")
+            except tarfile.ReadError as e:
+                log.error("Couldn't read crash log archive: %s", e)
+                # tar may still be writing, and with nothing reading the channel window never reopens so the exit
+                # status would never arrive. Closing the channel gives an exit status of -1 and the fallback runs
+                _stdout.channel.close()
+
+            # Fall back to a single recursive directory pull if the MFD couldn't produce an archive
+            _exit_status = _stdout.channel.recv_exit_status()
+            if _exit_status != 0:
+                log.error("tar command failed with exit status %s, pulling %s directly",
+                          _exit_status, _remote_directory)
+                self._pull_crash_log_directory(_remote_directory, log_file_name)
+
+    def _pull_crash_log_directory(self, remote_directory, log_file_name):
+        # The directory is pulled over the SFTP session pushing the crash log script, or with the system scp client
+        # if the MFD only supports SCP. Both recreate the remote directory inside their target, so the pull goes to a
+        # temporary directory first. The files are then moved into log_file_name with the same layout and file names
+        # the tar extraction uses, replacing anything the tar stream extracted before it failed
+        with tempfile.TemporaryDirectory(dir=self.local_path) as _temporary_directory:
+            if self.ssh_handler.sftp_session:
+                self.ssh_handler.pull_dir(remote_directory, _temporary_directory)
             else:
-                print(f"ls command failed with exit status {exit_status}")
-    def remove_mfd_crash_logs(self):
+                self.ssh_handler.pull_dir_native(remote_directory, _temporary_directory)
 
-    def reset_mfd_dropbox(self):
+            _pulled_directory = os.path.join(_temporary_directory, posixpath.basename(remote_directory))
+            for _root, _directories, _files in os.walk(_pulled_directory):
+                for _file in _files:
+                    _relative_path = os.path.relpath(os.path.join(_root, _file), _pulled_directory)
+                    _local_file = os.path.join(log_file_name, _relative_path.translate(_PATHSAFE))
+                    os.makedirs(os.path.dirname(_local_file), exist_ok=True)
+                    os.replace(os.path.join(_root, _file), _local_file)
 
+    def remove_mfd_crash_logs(self):
+        # todo remove the crash logs from the MFD once they have been pulled
+        pass
 
+    def reset_mfd_dropbox(self):
+        # todo reset the dropbox on the MFD
+        pass
 
     def get_mfd_crash_logs(self, host):
         # set up ssh
@@ -146,27 +199,51 @@ class MFDCrashLogs:
         pass
 
 
-class ProcessMFDCrashLogs(MFDCrashLogs):
-    def __init__(self, host):
-
+class ProcessMFDCrashLogs:
+    def __init__(self, hosts, crash_log_script_name, crash_log_script_path, local_crash_log_path, username,
+                 ssh_key_path):
 
-    def get_mfd_crash_logs(self, host):
-        for host in hosts:
-            ssh_handler = SSHHandler(host)
-            mfd_crash_logs = MFDCrashLogs(app.config['CRASH_LOG_DIR'], host, ssh_handler)
-            mfd_crash_logs.transfer_crash_log_script(app.config['CRASH_LOG_SCRIPT_PATH'])
-            mfd_crash_logs.execute_crash_log_script()
-            mfd_crash_logs.check_for_crash_logs()
-            mfd_crash_logs.pull_crash_logs()
+        self.hosts = hosts
+        self.crash_script = crash_log_script_name
+        self.script_path = crash_log_script_path
+        self.local_path = local_crash_log_path
+        self.username = username
+        self.ssh_key_path = ssh_key_path
+
+    def _run_one_host(self, host):
+        # Each worker borrows its own SSH session from the pool and hands it back once the host is finished. Crash
+        # logs are plain text so the transport is compressed
+        with SSHHandler(hostname=host["hostname"], username=self.username, ssh_key_path=self.ssh_key_path,
+                        enable_compression=True) as ssh_handler:
+            mfd_crash_logs = MFDCrashLogs(self.crash_script, self.script_path, self.local_path, host, ssh_handler)
+            mfd_crash_logs.transfer_crash_log_script()
+            crash_log_listing, exit_status = mfd_crash_logs.execute_crash_log_script()
+            mfd_crash_logs.pull_crash_logs(crash_log_listing, exit_status)
             mfd_crash_logs.remove_mfd_crash_logs()
             mfd_crash_logs.reset_mfd_dropbox()
-            mfd_crash_logs.get_mfd_crash_logs(host)
 
-        pass
+    def get_mfd_crash_logs(self):
+        # Every MFD is processed on its own worker thread, results are gathered as each host finishes so a slow MFD
+        # doesn't hold up the rest. Returns the hosts that failed.
+        failed_hosts = []
 
+        if not self.hosts:
+            return failed_hosts
 
+        # SSH sessions are left in the pool afterwards so the next sweep of the same MFDs skips the handshake
+        with ThreadPoolExecutor(max_workers=min(len(self.hosts), MAX_PARALLEL_HOSTS)) as pool:
+            futures = {pool.submit(self._run_one_host, host): host for host in self.hosts}
 
+            for future in as_completed(futures):
+                host = futures[future]
+                try:
+                    future.result()
+                    log.info("Finished collecting crash logs for %s", host["hostname"])
+                except Exception as e:
+                    log.error("Failed to collect crash logs for %s: %s", host["hostname"], e)
+                    failed_hosts.append(host)
 
+        return failed_hosts
 
 
 # get logs > sort logs > jira tickets > stats
@@ -20,7 +20,74 @@ import paramiko
 from scp import SCPClient, SCPException
 from time import sleep
 from contextlib import suppress
+from collections import deque
+from functools import lru_cache
+import threading
+import atexit
+import socket
+import subprocess
+import logging
 import errno
+import os
+import posixpath
+import stat
+import sys
+
+log = logging.getLogger(__name__)
+
+# Pool of authenticated SSH clients keyed by (hostname, username, ssh_key_path), shared across the process so that
+# repeat connections to the same host skip the TCP and SSH handshake. Pooled clients are kept for the life of the
+# process, the transport keepalive stops them going idle and dead clients are discarded by ssh_reuse
+_SSH_POOL = {}
+_SSH_POOL_LOCK = threading.Lock()
+
+# Limits the number of SSH handshakes in flight at once so that parallel callers stay below the default sshd
+# MaxStartups limit of 10 unauthenticated connections
+_SSH_CONNECT_SEMAPHORE = threading.BoundedSemaphore(8)
+
+# The default 2 MiB channel window throttles SCP on links with any real latency, so channels are opened with a window
+# just under 128 MiB. Rekeying is pushed out to 2^40 bytes/packets so long transfers aren't stalled by key exchange
+SSH_WINDOW_SIZE = 134_217_727
+SSH_REKEY_LIMIT = pow(2, 40)
+
+# Socket buffer size requested before connecting on platforms other than Linux. Linux autotunes the buffers up to
+# net.ipv4.tcp_rmem/tcp_wmem and setting them explicitly turns that off, capped at net.core.rmem_max/wmem_max, so
+# Linux is left to autotune. Other platforms may also cap the request, the size actually granted is logged
+SSH_PORT = 22
+SSH_SOCKET_BUFFER_SIZE = 32 << 20
+
+# Seconds between keepalive requests, stops idle sessions being dropped by NAT or sshd between pipeline phases
+SSH_KEEPALIVE_INTERVAL = 15
+
+# Appended to scripts run with execute_script so the exit status of the script can be read back from its output
+SCRIPT_EXIT_MARKER = "__EXIT__:"
+
+# Files are streamed through SFTP in 1 MiB reads
+SFTP_CHUNK_SIZE = 1 << 20
+
+# Limits on each batch of files prefetched together when pulling a directory over SFTP. Prefetched data is held in
+# memory until it is written out, so the byte limit bounds what a batch can buffer. A file larger than the byte
+# limit is pulled in a batch of its own
+SFTP_MAX_OPEN_FILES = 32
+SFTP_MAX_BATCH_BYTES = 32 << 20
+
+
+# Private key types tried, in order, when loading an SSH key
+SSH_KEY_TYPES = (paramiko.RSAKey, paramiko.ECDSAKey, paramiko.Ed25519Key)
+
+
+@lru_cache(maxsize=4)
+def _load_pkey(ssh_key_path):
+    # Parsing (and for encrypted keys, decrypting) the key is only done once per path rather than on every connect
+    last_exception = None
+    for key_type in SSH_KEY_TYPES:
+        try:
+            return key_type.from_private_key_file(ssh_key_path)
+        except paramiko.PasswordRequiredException:
+            raise
+        except paramiko.SSHException as e:
+            last_exception = e
+    raise paramiko.SSHException(f"Unsupported SSH key type in {ssh_key_path}: {last_exception}")
 
 
 class SSHError(Exception):
@@ -79,14 +146,24 @@ class SCPTransferError(SCPError):
 
 
 class SSHConnect:
+    # Connection state is held in slots rather than a per-instance dict, the subclasses below add no state of their
+    # own so SSHHandler instances stay small when many are created across parallel hosts
+    __slots__ = ("ssh_session", "scp_session", "sftp_session", "ssh_connection_status", "scp_connection_status",
+                 "pool_key", "enable_compression")
+
     def __init__(self):
 
         self.ssh_session = None
         self.scp_session = None
+        self.sftp_session = None
 
         self.ssh_connection_status = 1
         self.scp_connection_status = 1
 
+        self.pool_key = None
+
+        self.enable_compression = False
+
     def ssh_connect(self, hostname, username, ssh_key_path, force_connect=False):
         """
         ssh_connect Function:
@@ -94,7 +171,8 @@ class SSHConnect:
         The ssh_connect function is used to connect to a given SSH host.
 
         Call this function with a hostname, username and SSH key and it will attempt to connect to that device. In order to
-        establish a new connection when one is already open then set the force_connect parameter to True.
+        establish a new connection when one is already open then set the force_connect parameter to True. Set
+        enable_compression to True before connecting to negotiate a compressed transport.
 
         Usage:
         ssh_session = SSHConnect.ssh_connect(hostname="198.18.0.171", username="root", ssh_key_path="./axiom_rsa.key")
@@ -105,10 +183,10 @@ class SSHConnect:
         UnknownError: If an unknown error occurs
         """
 
-        print(f"Attempting to establish an SSH connection to {hostname}")
+        log.debug("Attempting to establish an SSH connection to %s", hostname)
 
         if self.ssh_connection_status == 2 and not force_connect:
-            print("Already connected to SSH session")
+            log.warning("Already connected to SSH session")
             raise SSHAlreadyConnectedError("SSH Connection already established")
 
         self.ssh_session = paramiko.SSHClient()
@@ -121,46 +199,59 @@ class SSHConnect:
 
         for connection_attempts in range(max_connection_attempts):
             try:
-                if ssh_key_path:
-                    self.ssh_session.connect(hostname=hostname, username=username, key_filename=ssh_key_path)
-                elif not ssh_key_path:
-                    print("Attempting SSH connection without SSH Key")
-                    with suppress(paramiko.ssh_exception.AuthenticationException):
-                        self.ssh_session.connect(hostname=hostname, username=username, password='')
-                    self.ssh_session.get_transport().auth_none(username)
-                print("SSH Connection Successful")
+                with _SSH_CONNECT_SEMAPHORE:
+                    pkey = _load_pkey(ssh_key_path) if ssh_key_path else None
+                    sock = self._open_socket(hostname)
+                    try:
+                        if ssh_key_path:
+                            self.ssh_session.connect(hostname=hostname, username=username, pkey=pkey,
+                                                     allow_agent=False, look_for_keys=False,
+                                                     compress=self.enable_compression, sock=sock)
+                        elif not ssh_key_path:
+                            log.debug("Attempting SSH connection without SSH Key")
+                            with suppress(paramiko.ssh_exception.AuthenticationException):
+                                self.ssh_session.connect(hostname=hostname, username=username, password='',
+                                                         compress=self.enable_compression, sock=sock)
+                            self.ssh_session.get_transport().auth_none(username)
+                    except BaseException:
+                        # SSHClient doesn't close a socket it was handed, so a failed handshake would leak it
+                        self.ssh_session.close()
+                        sock.close()
+                        raise
+                self._tune_transport()
+                log.info("SSH Connection Successful")
                 self.ssh_connection_status = 2
+                self.pool_key = (hostname, username, ssh_key_path)
                 return self.ssh_session
 
             except paramiko.ssh_exception.AuthenticationException:
-                print("Authentication failed, please verify your credentials.")
+                log.error("Authentication failed, please verify your credentials.")
                 raise SSHAuthenticationError("Authentication failed, verify SSH Key and credentials")
 
             except OSError as e:
                 last_exception = e
                 if e.errno == errno.ENETUNREACH:
-                    print(f"Network is unreachable, reconnection attempt {connection_attempts + 1}"
-                          f" of {max_connection_attempts}.")
+                    log.warning("Network is unreachable, reconnection attempt %s of %s.",
+                                connection_attempts + 1, max_connection_attempts)
                 elif e.errno == 10065:
-                    print(f"The host is unreachable, reconnection attempt {connection_attempts + 1}"
-                          f" of {max_connection_attempts}.")
+                    log.warning("The host is unreachable, reconnection attempt %s of %s.",
+                                connection_attempts + 1, max_connection_attempts)
                 else:
-                    print(f"Socket error: {e}, reconnection attempt {connection_attempts + 1}"
-                          f" of {max_connection_attempts}.")
+                    log.warning("Socket error: %s, reconnection attempt %s of %s.",
+                                e, connection_attempts + 1, max_connection_attempts)
 
             except paramiko.SSHException as e:
                 last_exception = e
-                print(f"SSH Exception occurred: {e}, reconnection attempt {connection_attempts + 1}"
-                      f" of {max_connection_attempts}.")
+                log.warning("SSH Exception occurred: %s, reconnection attempt %s of %s.",
+                            e, connection_attempts + 1, max_connection_attempts)
 
             except Exception as e:
                 last_exception = e
-                print(f"An unexpected error occurred: {e}")
+                log.error("An unexpected error occurred: %s", e)
 
             if connection_attempts < max_connection_attempts - 1:
-                print(
-                    f"Connection attempt {connection_attempts + 1} of {max_connection_attempts} failed."
-                    f" Retrying in {retry_delay} seconds.")
+                log.warning("Connection attempt %s of %s failed. Retrying in %s seconds.",
+                            connection_attempts + 1, max_connection_attempts, retry_delay)
                 sleep(retry_delay)
 
         if isinstance(last_exception, OSError):
@@ -175,6 +266,67 @@ class SSHConnect:
                 f"SSH Connection failed due to an unknown reason after {max_connection_attempts} attempts:"
                 f" {last_exception}")
 
+    @staticmethod
+    def _open_socket(hostname):
+        # Nagle is disabled so small command/ack packets go out immediately, see SSH_SOCKET_BUFFER_SIZE for the
+        # buffers. Every address the hostname resolves to (IPv4 or IPv6) is tried in turn, the same as SSHClient does
+        # when it opens the socket itself
+        last_exception = OSError(f"No addresses found for {hostname}")
+        for family, socktype, proto, _, address in socket.getaddrinfo(hostname, SSH_PORT, type=socket.SOCK_STREAM):
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if not sys.platform.startswith("linux"):
+                    SSHConnect._size_socket_buffers(sock)
+                sock.connect(address)
+                return sock
+            except OSError as e:
+                sock.close()
+                last_exception = e
+        raise last_exception
+
+    @staticmethod
+    def _size_socket_buffers(sock):
+        for option, name in ((socket.SO_SNDBUF, "send"), (socket.SO_RCVBUF, "receive")):
+            sock.setsockopt(socket.SOL_SOCKET, option, SSH_SOCKET_BUFFER_SIZE)
+            granted = sock.getsockopt(socket.SOL_SOCKET, option)
+            if granted < SSH_SOCKET_BUFFER_SIZE:
+                log.debug("SSH socket %s buffer capped at %s bytes, %s requested", name, granted,
+                          SSH_SOCKET_BUFFER_SIZE)
+
+    def _tune_transport(self):
+        # Channels opened after this point (commands and SCP) pick up the larger window
+        transport = self.ssh_session.get_transport()
+        transport.default_window_size = SSH_WINDOW_SIZE
+        transport.packetizer.REKEY_BYTES = SSH_REKEY_LIMIT
+        transport.packetizer.REKEY_PACKETS = SSH_REKEY_LIMIT
+        transport.set_keepalive(SSH_KEEPALIVE_INTERVAL)
+
+    def _ensure_alive(self):
+        # Checks the SSH transport is still usable before an operation and reconnects once if it has dropped. An open
+        # SCP/SFTP session is reopened on the new transport
+        transport = self.ssh_session.get_transport()
+        try:
+            if transport is None or not transport.is_active():
+                raise paramiko.SSHException("SSH transport is not active")
+            transport.send_ignore()
+            return
+        except (paramiko.SSHException, OSError, EOFError) as e:
+            log.warning("SSH connection has dropped, attempting to reconnect. Exception: %s", e)
+
+        reconnect_scp = self.scp_connection_status == 2
+        with suppress(paramiko.SSHException, OSError, EOFError):
+            self.ssh_session.close()
+
+        hostname, username, ssh_key_path = self.pool_key
+        self.ssh_connect(hostname, username, ssh_key_path, force_connect=True)
+
+        if reconnect_scp:
+            self.sftp_session = None
+            self.scp_session = None
+            self.scp_connection_status = 1
+            self.scp_connect()
+
     def ssh_disconnect(self):
         """
         ssh_disconnect Function:
@@ -190,22 +342,102 @@ class SSHConnect:
         SSHConnectionError: If the SSH disconnection fails
         """
 
-        print("Attempting to disconnect SSH Connection")
+        log.debug("Attempting to disconnect SSH Connection")
         try:
             if self.ssh_connection_status == 2:
                 self.ssh_session.close()
                 self.ssh_connection_status = 1
                 self.ssh_session = None
-                print(f"SSH session successfully closed. SSH Connection Status Code: "
-                      f"{self.ssh_connection_status}")
+                log.info("SSH session successfully closed. SSH Connection Status Code: %s", self.ssh_connection_status)
             elif self.ssh_connection_status in (0, 1):
-                print(f"SSH not connected, cannot disconnect. SSH Connection Status Code:"
-                      f" {self.ssh_connection_status}")
+                log.error("SSH not connected, cannot disconnect. SSH Connection Status Code: %s",
+                          self.ssh_connection_status)
                 raise SSHConnectionError("SSH Disconnection failed: No SSH session to close")
         except (paramiko.SSHException, OSError) as e:
-            print(f"An error occurred while closing the SSH connection: {e}")
+            log.error("An error occurred while closing the SSH connection: %s", e)
             raise SSHConnectionError(f"SSH Disconnection failed: {e}")
 
+    def ssh_reuse(self, hostname, username, ssh_key_path):
+        """
+        ssh_reuse Function:
+
+        The ssh_reuse function is used to take an already authenticated SSH session from the connection pool.
+
+        Call this function with a hostname, username and SSH key and it will return a pooled session for that device if
+        one is available. Pooled sessions whose transport has dropped are closed and discarded. If no session is
+        available then None is returned and ssh_connect should be called instead.
+
+        Usage:
+        if not SSHConnect.ssh_reuse(hostname="198.18.0.171", username="root", ssh_key_path="./axiom_rsa.key"):
+            SSHConnect.ssh_connect(hostname="198.18.0.171", username="root", ssh_key_path="./axiom_rsa.key")
+        """
+
+        pool_key = (hostname, username, ssh_key_path)
+
+        with _SSH_POOL_LOCK:
+            pooled_sessions = _SSH_POOL.get(pool_key)
+            while pooled_sessions:
+                ssh_session = pooled_sessions.popleft()
+                transport = ssh_session.get_transport()
+                if transport is not None and transport.is_active():
+                    log.debug("Reusing pooled SSH connection to %s", hostname)
+                    self.ssh_session = ssh_session
+                    self.ssh_connection_status = 2
+                    self.pool_key = pool_key
+                    return self.ssh_session
+                ssh_session.close()
+
+        return None
+
+    def ssh_release(self):
+        """
+        ssh_release Function:
+
+        The ssh_release function is used to return the connected SSH session to the connection pool.
+
+        Call this function instead of ssh_disconnect when the session may be used again, the underlying transport is
+        left open so that the next SSHHandler for the same host can pick it up with ssh_reuse.
+
+        Usage:
+        SSHConnect.ssh_release()
+
+        Raises:
+        SSHConnectionError: If there is no SSH session to release
+        """
+
+        log.debug("Attempting to return SSH Connection to the pool")
+        if self.ssh_connection_status != 2:
+            log.error("SSH not connected, cannot release. SSH Connection Status Code: %s", self.ssh_connection_status)
+            raise SSHConnectionError("SSH Release failed: No SSH session to release")
+
+        with _SSH_POOL_LOCK:
+            _SSH_POOL.setdefault(self.pool_key, deque()).append(self.ssh_session)
+
+        self.ssh_session = None
+        self.ssh_connection_status = 1
+        log.info("SSH session returned to the pool. SSH Connection Status Code: %s", self.ssh_connection_status)
+
+    @staticmethod
+    def close_pool():
+        """
+        close_pool Function:
+
+        The close_pool function is used to close every SSH session held in the connection pool.
+
+        This is called automatically when the process exits. Call it directly to drop the pooled sessions sooner, for
+        example when the remote devices are about to be rebooted.
+
+        Usage:
+        SSHConnect.close_pool()
+        """
+
+        with _SSH_POOL_LOCK:
+            for pooled_sessions in _SSH_POOL.values():
+                while pooled_sessions:
+                    with suppress(paramiko.SSHException, OSError):
+                        pooled_sessions.popleft().close()
+            _SSH_POOL.clear()
+
     def scp_connect(self):
         """
         scp_connect Function:
@@ -214,6 +446,9 @@ class SSHConnect:
 
         First call the ssh_connect function and then call scp_connect in order to push/pull files to and from the remote
 
+        An SFTP session is opened when the remote supports it, as it allows writes to be pipelined. Remotes without an
+        SFTP subsystem fall back to an SCP session.
+
         Usage:
         SSHConnect.ssh_connect(hostname="198.18.0.171", username="root", ssh_key_path="./axiom_rsa.key")
 
@@ -223,29 +458,38 @@ class SSHConnect:
         SCPConnectionError: If the SCP connection fails
         """
 
-        print("Attempting to establish the SCP connection")
+        log.debug("Attempting to establish the SCP connection")
         try:
             if self.ssh_connection_status == 2:
                 if self.ssh_session:
+                    try:
+                        self.sftp_session = self.ssh_session.open_sftp()
+                        self.scp_connection_status = 2
+                        log.info("Successfully connected to SFTP server. SCP Connection Status Code: %s",
+                                 self.scp_connection_status)
+                        return self.sftp_session
+                    except paramiko.SSHException as e:
+                        log.warning("SFTP is not available on the remote, falling back to SCP. Exception: %s", e)
+
                     self.scp_session = SCPClient(self.ssh_session.get_transport())
                     self.scp_connection_status = 2
-                    print(f"Successfully connected to SCP server. SCP Connection Status Code: "
-                          f"{self.scp_connection_status}")
+                    log.info("Successfully connected to SCP server. SCP Connection Status Code: %s",
+                             self.scp_connection_status)
                     return self.scp_session
             else:
                 self.scp_connection_status = 0
-                print(f"Not connected to SSH session, cannot connect to SCP server. SCP Connection Status Code: "
-                      f"{self.scp_connection_status}")
+                log.error("Not connected to SSH session, cannot connect to SCP server. SCP Connection Status Code: %s",
+                          self.scp_connection_status)
                 raise SCPConnectionError("SCP Connection failed: No SSH session available")
         except (paramiko.SSHException, OSError) as e:
             self.scp_connection_status = 0
-            print(f"An error occurred while opening the SCP connection. SCP Connection Status Code: "
-                  f"{self.scp_connection_status} Exception: {e}")
+            log.error("An error occurred while opening the SCP connection. SCP Connection Status Code: %s Exception: "
+                      "%s", self.scp_connection_status, e)
             raise SCPConnectionError(f"SCP Connection failed: {e}")
         except Exception as e:
             self.scp_connection_status = 0
-            print(f"An unexpected error occurred while attempting SCP connection. SCP Connection Status Code: "
-                  f"{self.scp_connection_status} Exception: {e}")
+            log.error("An unexpected error occurred while attempting SCP connection. SCP Connection Status Code: %s "
+                      "Exception: %s", self.scp_connection_status, e)
             raise SCPConnectionError(f"SCP Connection failed: {e}")
 
     def scp_disconnect(self):
@@ -263,23 +507,28 @@ class SSHConnect:
         SCPConnectionError: If the SCP disconnection fails
         """
 
-        print("Attempting to disconnect SCP connection")
+        log.debug("Attempting to disconnect SCP connection")
         try:
             if self.scp_connection_status == 2:
-                self.scp_session.close()
+                if self.sftp_session:
+                    self.sftp_session.close()
+                if self.scp_session:
+                    self.scp_session.close()
                 self.scp_connection_status = 1
+                self.sftp_session = None
                 self.scp_session = None
-                print(f"SCP session successfully closed. SCP Connection Status Code: {self.scp_connection_status}")
+                log.info("SCP session successfully closed. SCP Connection Status Code: %s", self.scp_connection_status)
             elif self.scp_connection_status in (0, 1):
-                print(f"SCP not connected, cannot disconnect. SCP Connection Status Code: {self.scp_connection_status}")
+                log.error("SCP not connected, cannot disconnect. SCP Connection Status Code: %s",
+                          self.scp_connection_status)
                 raise SCPConnectionError("SCP Disconnection failed: No SCP session to close")
         except (paramiko.SSHException, OSError) as e:
-            print(f"An error occurred while closing the SCP connection: SCP Connection Status Code: "
-                  f"{self.scp_connection_status} Exception: {e}")
+            log.error("An error occurred while closing the SCP connection: SCP Connection Status Code: %s Exception: "
+                      "%s", self.scp_connection_status, e)
             raise SCPConnectionError(f"SCP Disconnection failed: {e}")
         except Exception as e:
-            print(f"An unexpected error occurred while attempting SCP connection. SCP Connection Status Code: "
-                  f"{self.scp_connection_status} Exception: {e}")
+            log.error("An unexpected error occurred while attempting SCP connection. SCP Connection Status Code: %s "
+                      "Exception: %s", self.scp_connection_status, e)
             raise SCPConnectionError(f"SCP Disconnection failed for an unknown reason: {e}")
 
     def disconnect_all(self):
@@ -288,7 +537,8 @@ class SSHConnect:
 
         The disconnect_all function is used to disconnect from any connected SSH and SCP hosts.
 
-        Call this function, and it will attempt to close the open SSH and SCP sessions.
+        Call this function, and it will attempt to close the open SCP session and return the SSH session to the
+        connection pool. Use ssh_disconnect or close_pool to close the SSH transport itself.
 
         Usage:
         SSHConnect.disconnect_all()
@@ -302,42 +552,62 @@ class SSHConnect:
                 self.scp_disconnect()
 
             if self.ssh_connection_status == 2:
-                self.ssh_disconnect()
+                self.ssh_release()
 
-            print(f"Successfully disconnected from SSH and SCP connections. "
-                  f"SSH Connection Status: {self.ssh_connection_status} "
-                  f"SCP Connection Status: {self.scp_connection_status}")
+            log.info("Successfully disconnected from SSH and SCP connections. SSH Connection Status: %s SCP "
+                     "Connection Status: %s", self.ssh_connection_status, self.scp_connection_status)
 
         except (SCPConnectionError, SSHConnectionError) as e:
             raise SSHError(f"An error occurred when disconnecting all sessions: {e}")
 
 
 class SSHCommands(SSHConnect):
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
+
+    def _exec_command_combined(self, command):
+        # Runs the command without a pseudo-terminal, so output isn't line buffered or rewritten with carriage returns.
+        # stderr is merged into stdout before the command starts, otherwise anything it writes early is missed
+        channel = self.ssh_session.get_transport().open_session()
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        return channel.makefile_stdin("wb"), channel.makefile("r")
+
+    @staticmethod
+    def _read_output(stdout):
+        # Reads the whole output in one go and splits it into lines without line endings
+        return stdout.read().decode("utf-8", "replace").splitlines()
 
     def execute_command(self, command):
         """
         execute_command Function:
 
-        This function is used to execute a command through the connected SSH session
+        This function is used to execute a command through the connected SSH session. It waits for the command to
+        finish and returns its exit status, the output is discarded
 
         Usage:
         SSHConnect.ssh_connect(hostname="198.18.0.171", username="root", ssh_key_path="./axiom_rsa.key")
 
-        SSHCommands.execute_command("ls /mnt/internal_slot1")
+        exit_status = SSHCommands.execute_command("ls /mnt/internal_slot1")
 
         Raises:
         ExecuteCommandError: If the command execution fails
         """
 
         if self.ssh_connection_status == 2:
-            print(f"Attempting to Execute Command: {command}")
-            self.ssh_session.exec_command(command)
-            print(f"Successfully Executed Command: {command}, without reading lines")
+            self._ensure_alive()
+            log.debug("Attempting to Execute Command: %s", command)
+            stdin, stdout = self._exec_command_combined(command)
+            stdin.close()
+            # The output still has to be read, a command that fills the channel window blocks until it is
+            for _ in iter(lambda: stdout.read(SFTP_CHUNK_SIZE), b""):
+                pass
+            exit_status = stdout.channel.recv_exit_status()
+            log.debug("Successfully Executed Command: %s, discarding its output. Exit status: %s", command,
+                      exit_status)
+            return exit_status
         elif self.ssh_connection_status in (0, 1):
-            print(f"SSH not connected, cannot execute command. SSH Connection Status Code: "
-                  f"{self.ssh_connection_status}")
+            log.error("SSH not connected, cannot execute command. SSH Connection Status Code: %s",
+                      self.ssh_connection_status)
             raise ExecuteCommandError("SSH Command execution failed: No SSH session available")
 
     def execute_command_with_output(self, command):
@@ -356,18 +626,17 @@ class SSHCommands(SSHConnect):
         """
 
         if self.ssh_connection_status == 2:
-            print(f"Attempting to Execute Command: {command} and read the output")
-            stdin, stdout, stderr = self.ssh_session.exec_command(command, get_pty=True)
-            stdout.channel.set_combine_stderr(True)
-            output = stdout.readlines()
+            self._ensure_alive()
+            log.debug("Attempting to Execute Command: %s and read the output", command)
+            stdin, stdout = self._exec_command_combined(command)
+            output = self._read_output(stdout)
 
-            print(f"Successfully Executed Command: {command} and read the output")
+            log.debug("Successfully Executed Command: %s and read the output", command)
 
             if not output:
                 raise ExecuteCommandError("The command did not return any output")
 
-            output = [s.replace("\n", "").replace("\r", "") for s in output]
-            print(f"Output of {command}: {output}")
+            log.debug("Output of %s: %s", command, output)
 
             return output
 
@@ -381,38 +650,119 @@ class SSHCommands(SSHConnect):
         Usage:
         SSHConnect.ssh_connect(hostname="198.18.0.171", username="root", ssh_key_path="./axiom_rsa.key")
 
-        output, exit_status = SSHCommands.execute_command_with_output("ls /mnt/internal_slot1")
+        output, exit_status = SSHCommands.execute_command_with_exit_status("ls /mnt/internal_slot1")
+        if exit_status != 0:
+            print("ls failed, /mnt/internal_slot1 may not exist")
 
         Raises:
         ExecuteCommandError: If the command execution fails
         """
 
         if self.ssh_connection_status == 2:
-            print(f"Attempting to Execute Command: {command} and read the output and exit status")
-            stdin, stdout, stderr = self.ssh_session.exec_command(command, get_pty=True)
-            stdout.channel.set_combine_stderr(True)
-            output = stdout.readlines()
+            self._ensure_alive()
+            log.debug("Attempting to Execute Command: %s and read the output and exit status", command)
+            stdin, stdout = self._exec_command_combined(command)
+            output = self._read_output(stdout)
             stdin.close()
             stdout.channel.shutdown_write()
             exit_status = stdout.channel.recv_exit_status()
 
-            print(f"Successfully Executed Command: {command}")
+            log.debug("Successfully Executed Command: %s", command)
+            log.debug("Output of %s: %s", command, output)
 
-            if not output:
-                raise ExecuteCommandError("The command did not return any output")
+            # paramiko reports -1 when the server closes the channel without sending an exit status
+            if exit_status == -1:
+                raise ExecuteCommandError("The command did not return an exit status")
+
+            return output, exit_status
 
-            output = [s.replace("\n", "").replace("\r", "") for s in output]
-            print(f"Output of {command}: {output}")
+    def execute_script(self, script):
+        """
+        execute_script Function:
 
-            if not exit_status:
-                raise ExecuteCommandError("The command did not return an exit status")
+        This function is used to execute a multi-line shell script through the connected SSH session in a single
+        call and return the output and the exit status of the last command in the script. Use this to batch
+        sequential commands instead of paying for a new channel per command.
+
+        Usage:
+        SSHConnect.ssh_connect(hostname="198.18.0.171", username="root", ssh_key_path="./axiom_rsa.key")
+
+        output, exit_status = SSHCommands.execute_script("chmod +x ./test.sh && ./test.sh && ls /mnt/internal_slot1")
+
+        Raises:
+        ExecuteCommandError: If the script execution fails
+        """
+
+        if self.ssh_connection_status == 2:
+            self._ensure_alive()
+            log.debug("Attempting to Execute Script: %s and read the output and exit status", script)
+            # The exit status marker is printed on a line of its own, the script output may not end with a newline
+            try:
+                stdin, stdout, stderr = self.ssh_session.exec_command(
+                    f"{script}\nprintf '\\n%s%s\\n' {SCRIPT_EXIT_MARKER} \"$?\"")
+            except paramiko.SSHException as e:
+                log.error("SSH Exception occurred while executing script: %s", e)
+                raise ExecuteCommandError(f"SSH Script execution failed: {e}")
+            stdin.close()
+            output, marker, exit_status = stdout.read().decode("utf-8", "replace").rpartition(SCRIPT_EXIT_MARKER)
+            stdout.channel.recv_exit_status()
+
+            if not marker or not exit_status.strip().isdigit():
+                raise ExecuteCommandError("The script did not return an exit status")
+
+            # Drop the newline printed ahead of the marker
+            output = output[:-1].splitlines()
+            exit_status = int(exit_status)
+
+            log.debug("Successfully Executed Script: %s", script)
+            log.debug("Output of %s: %s", script, output)
 
             return output, exit_status
+        elif self.ssh_connection_status in (0, 1):
+            log.error("SSH not connected, cannot execute script. SSH Connection Status Code: %s",
+                      self.ssh_connection_status)
+            raise ExecuteCommandError("SSH Script execution failed: No SSH session available")
+
+    def execute_command_with_stream(self, command):
+        """
+        execute_command_with_stream Function:
+
+        This function is used to execute a command through the connected SSH session and return its stdout as a
+        file-like object, allowing large outputs such as archives to be read incrementally instead of all at once.
+        Once the stream has been read, the exit status is available from stdout.channel.recv_exit_status()
+
+        Usage:
+        SSHConnect.ssh_connect(hostname="198.18.0.171", username="root", ssh_key_path="./axiom_rsa.key")
+
+        stdout = SSHCommands.execute_command_with_stream("tar -C /mnt/internal_slot1 -cf - .")
+        with tarfile.open(fileobj=stdout, mode="r|") as archive:
+            archive.extractall("./internal_slot1")
+
+        Raises:
+        ExecuteCommandError: If the command execution fails
+        """
+
+        if self.ssh_connection_status == 2:
+            self._ensure_alive()
+            log.debug("Attempting to Execute Command: %s and stream the output", command)
+            try:
+                stdin, stdout, stderr = self.ssh_session.exec_command(command)
+            except paramiko.SSHException as e:
+                log.error("SSH Exception occurred while executing command: %s", e)
+                raise ExecuteCommandError(f"SSH Command execution failed: {e}")
+            stdin.close()
+
+            log.debug("Successfully Executed Command: %s, output is being streamed", command)
+
+            return stdout
+        elif self.ssh_connection_status in (0, 1):
+            log.error("SSH not connected, cannot execute command. SSH Connection Status Code: %s",
+                      self.ssh_connection_status)
+            raise ExecuteCommandError("SSH Command execution failed: No SSH session available")
 
 
 class SCPFileTransfer(SSHConnect):
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
 
     def push_file(self, local_path, remote_path):
         """
@@ -436,36 +786,40 @@ class SCPFileTransfer(SSHConnect):
         local_path = local_path
         remote_path = remote_path
 
-        print(f"Attempting to push {local_path} to {remote_path}")
+        log.debug("Attempting to push %s to %s", local_path, remote_path)
 
         if self.scp_connection_status != 2:
-            print(f"Not connected to SCP. SCP Connection Status Code: {self.scp_connection_status}")
+            log.error("Not connected to SCP. SCP Connection Status Code: %s", self.scp_connection_status)
             raise SCPConnectionError("There is no established SCP connection")
 
+        self._ensure_alive()
+
         try:
-            print(f"Pushing {local_path} to {remote_path}")
-            self.scp_session.put(local_path, remote_path)
-            print(f"Successfully pushed {local_path} to {remote_path}")
+            if self.sftp_session:
+                self._sftp_push(local_path, remote_path)
+            else:
+                self.scp_session.put(local_path, remote_path)
+            log.debug("Successfully pushed %s to %s", local_path, remote_path)
         except FileNotFoundError:
-            print(f"Local file ({local_path}) not found.")
+            log.error("Local file (%s) not found.", local_path)
             raise SCPTransferError("Local file not found")
         except PermissionError:
-            print(f"Permission denied when accessing {local_path} or writing to {remote_path}.")
+            log.error("Permission denied when accessing %s or writing to %s.", local_path, remote_path)
             raise SCPTransferError("Permission denied")
         except TimeoutError:
-            print("SCP operation timed out.")
+            log.error("SCP operation timed out.")
             raise SCPTransferError("SCP operation timed out")
         except OSError as e:
-            print(f"OS error during SCP operation: {e}")
+            log.error("OS error during SCP operation: %s", e)
             raise SCPTransferError("Unknown OS error")
-        except SCPException as e:
-            print(f"Remote Path ({remote_path}) does not exist. SCP Exception: {e}")
+        except (SCPException, paramiko.SFTPError) as e:
+            log.error("Remote Path (%s) does not exist. SCP Exception: %s", remote_path, e)
             raise SCPTransferError("Remote path does not exist")
         except paramiko.SSHException as e:
-            print(f"SSH Connection Failed during SCP Put. SCP Exception: {e}")
+            log.error("SSH Connection Failed during SCP Put. SCP Exception: %s", e)
             raise SCPTransferError("SSH Connection failed during SCP Put")
         except Exception as e:
-            print(f"An unexpected exception occurred during SCP Put. SCP Exception: {e}")
+            log.error("An unexpected exception occurred during SCP Put. SCP Exception: %s", e)
             raise SCPTransferError("Unexpected exception occurred during SCP Put")
 
     """
@@ -509,54 +863,269 @@ class SCPFileTransfer(SSHConnect):
         local_path = local_path
         remote_path = remote_path
 
-        print(f"Attempting to pull {remote_path} to {local_path}")
+        log.debug("Attempting to pull %s to %s", remote_path, local_path)
 
         if self.scp_connection_status != 2:
-            print(f"Not connected to SCP. SCP Connection Status Code: {self.scp_connection_status}")
+            log.error("Not connected to SCP. SCP Connection Status Code: %s", self.scp_connection_status)
             raise SCPConnectionError("There is no established SCP connection")
 
+        self._ensure_alive()
+
         try:
-            self.scp_session.get(remote_path, local_path)
-            print(f"Successfully pulled {remote_path} to {local_path}")
-        except SCPException as e:
-            print(
-                f"SCP error occurred: {e}. Possible causes include the remote file not existing or permission issues.")
+            if self.sftp_session:
+                self._sftp_pull(local_path, remote_path)
+            else:
+                self.scp_session.get(remote_path, local_path)
+            log.debug("Successfully pulled %s to %s", remote_path, local_path)
+        except (SCPException, paramiko.SFTPError) as e:
+            log.error("SCP error occurred: %s. Possible causes include the remote file not existing or permission "
+                      "issues.", e)
             raise SCPTransferError("Unknown SCP error occurred")
         except paramiko.SSHException as e:
-            print(f"SSH error during SCP operation: {e}")
+            log.error("SSH error during SCP operation: %s", e)
             raise SCPTransferError("SSH error occurred during SCP operation")
         except PermissionError:
-            print(f"Permission denied when writing to {local_path}.")
+            log.error("Permission denied when writing to %s.", local_path)
             raise SCPTransferError("Permission denied")
         except FileNotFoundError:
-            print(f"Local path {local_path} does not exist.")
+            log.error("Local path %s does not exist.", local_path)
             raise SCPTransferError("Local path does not exist")
         except TimeoutError:
-            print("SCP operation timed out.")
+            log.error("SCP operation timed out.")
             raise SCPTransferError("SCP operation timed out")
         except OSError as e:
-            print(f"OS error during SCP operation: {e}")
+            log.error("OS error during SCP operation: %s", e)
             raise SCPTransferError("Unknown OS error")
         except Exception as e:
-            print(f"Unexpected error during SCP operation: {e}")
+            log.error("Unexpected error during SCP operation: %s", e)
             raise SCPTransferError("Unexpected error occurred during SCP operation")
 
 
+    def _sftp_open(self, remote_path, mode):
+        # paramiko reports a missing remote file as FileNotFoundError, the same as a missing local file. Raise it as an
+        # SFTPError instead so it is reported as a remote path problem
+        try:
+            return self.sftp_session.open(remote_path, mode)
+        except FileNotFoundError as e:
+            raise paramiko.SFTPError(f"{remote_path}: {e.strerror}") from e
+
+    def _sftp_push(self, local_path, remote_path):
+        # Like scp, a remote directory means the file keeps its local name
+        with suppress(IOError):
+            if stat.S_ISDIR(self.sftp_session.stat(remote_path).st_mode):
+                remote_path = posixpath.join(remote_path, os.path.basename(local_path))
+
+        # Pipelining stops each write waiting on its acknowledgement, memoryview avoids copying each chunk
+        with open(local_path, "rb") as local_file, self._sftp_open(remote_path, "wb") as remote_file:
+            remote_file.set_pipelined(True)
+            for chunk in iter(lambda: local_file.read(SFTP_CHUNK_SIZE), b""):
+                remote_file.write(memoryview(chunk))
+
+    def _sftp_pull(self, local_path, remote_path):
+        if os.path.isdir(local_path):
+            local_path = os.path.join(local_path, posixpath.basename(remote_path))
+
+        # Prefetching requests the whole file up front instead of one read at a time
+        with self._sftp_open(remote_path, "rb") as remote_file, open(local_path, "wb") as local_file:
+            remote_file.prefetch()
+            for chunk in iter(lambda: remote_file.read(SFTP_CHUNK_SIZE), b""):
+                local_file.write(chunk)
+
+    def pull_dir(self, remote_dir, local_dir):
+        """
+        pull_dir Function:
+
+        This function is used to recursively pull a directory from a remote host over the connected SCP session. The
+        directory is created inside local_dir, as with scp -r. Over SFTP the reads for a batch of files are all
+        issued before any file is written, so the transfer isn't held up waiting on each file in turn. Batches are
+        limited by SFTP_MAX_OPEN_FILES and SFTP_MAX_BATCH_BYTES.
+
+        Usage:
+        SSHConnect.ssh_connect(hostname="198.18.0.171", username="root", ssh_key_path="./axiom_rsa.key")
+        SSHConnect.scp_connect()
+
+        local_dir = "./"
+        remote_dir = "/mnt/internal_slot1/logs"
+
+        SCPFileTransfer.pull_dir(remote_dir, local_dir)
+
+        Raises:
+        SCPTransferError: If the SCP transfer fails
+        """
+
+        log.debug("Attempting to pull %s to %s", remote_dir, local_dir)
+
+        if self.scp_connection_status != 2:
+            log.error("Not connected to SCP. SCP Connection Status Code: %s", self.scp_connection_status)
+            raise SCPConnectionError("There is no established SCP connection")
+
+        self._ensure_alive()
+
+        try:
+            if self.sftp_session:
+                self._sftp_pull_dir(remote_dir, local_dir)
+            else:
+                self.scp_session.get(remote_dir, local_dir, recursive=True)
+            log.debug("Successfully pulled %s to %s", remote_dir, local_dir)
+        except (SCPException, paramiko.SFTPError) as e:
+            log.error("SCP error occurred: %s. Possible causes include the remote directory not existing or permission "
+                      "issues.", e)
+            raise SCPTransferError("Unknown SCP error occurred")
+        except paramiko.SSHException as e:
+            log.error("SSH error during SCP operation: %s", e)
+            raise SCPTransferError("SSH error occurred during SCP operation")
+        except OSError as e:
+            log.error("OS error during SCP operation: %s", e)
+            raise SCPTransferError("Unknown OS error")
+
+    def _sftp_pull_dir(self, remote_dir, local_dir):
+        local_dir = os.path.join(local_dir, posixpath.basename(remote_dir.rstrip("/")))
+        os.makedirs(local_dir, exist_ok=True)
+
+        remote_files = []
+        for entry in self.sftp_session.listdir_attr(remote_dir):
+            remote_path = posixpath.join(remote_dir, entry.filename)
+            if stat.S_ISDIR(entry.st_mode):
+                self._sftp_pull_dir(remote_path, local_dir)
+            else:
+                remote_files.append((remote_path, os.path.join(local_dir, entry.filename), entry.st_size))
+
+        batch = []
+        batch_bytes = 0
+        for remote_path, local_path, file_size in remote_files:
+            if batch and (len(batch) == SFTP_MAX_OPEN_FILES or batch_bytes + file_size > SFTP_MAX_BATCH_BYTES):
+                self._sftp_pull_batch(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append((remote_path, local_path, file_size))
+            batch_bytes += file_size
+        if batch:
+            self._sftp_pull_batch(batch)
+
+    def _sftp_pull_batch(self, batch):
+        open_files = []
+        try:
+            for remote_path, local_path, file_size in batch:
+                remote_file = self._sftp_open(remote_path, "rb")
+                open_files.append(remote_file)
+                remote_file.prefetch(file_size)
+
+            for remote_file, (remote_path, local_path, file_size) in zip(open_files, batch):
+                with open(local_path, "wb") as local_file:
+                    for chunk in iter(lambda: remote_file.read(SFTP_CHUNK_SIZE), b""):
+                        local_file.write(chunk)
+        finally:
+            for remote_file in open_files:
+                remote_file.close()
+
+    def pull_dir_native(self, remote_dir, local_dir):
+        """
+        pull_dir_native Function:
+
+        This function is used to recursively pull a directory from a remote host using the system scp client, which
+        is considerably faster than paramiko for bulk transfers. The host, username and SSH key of the connected
+        SSH session are reused, and like the paramiko session's AutoAddPolicy any host key is accepted without being
+        saved to known_hosts, so reflashed devices with a new host key can still be pulled from. On platforms that
+        support it, an SSH ControlMaster socket is shared between calls so that authentication is only performed once.
+
+        Usage:
+        SSHConnect.ssh_connect(hostname="198.18.0.171", username="root", ssh_key_path="./axiom_rsa.key")
+
+        local_dir = "./"
+        remote_dir = "/mnt/internal_slot1/logs"
+
+        SCPFileTransfer.pull_dir_native(remote_dir, local_dir)
+
+        Raises:
+        SCPConnectionError: If there is no SSH session to take the connection details from
+        SCPTransferError: If the scp transfer fails
+        """
+
+        log.debug("Attempting to pull %s to %s with the system scp client", remote_dir, local_dir)
+
+        if self.ssh_connection_status != 2:
+            log.error("Not connected to SSH. SSH Connection Status Code: %s", self.ssh_connection_status)
+            raise SCPConnectionError("There is no established SSH connection")
+
+        hostname, username, ssh_key_path = self.pool_key
+
+        scp_command = ["scp", "-C", "-r", "-o", "BatchMode=yes", "-o", "StrictHostKeyChecking=no",
+                       "-o", f"UserKnownHostsFile={os.devnull}"]
+        if ssh_key_path:
+            scp_command += ["-i", ssh_key_path]
+        # Windows OpenSSH doesn't support connection multiplexing
+        if os.name != "nt":
+            scp_command += ["-o", "ControlMaster=auto", "-o", "ControlPersist=60",
+                            "-o", "ControlPath=~/.ssh/cm-%r@%h:%p"]
+        scp_command += [f"{username}@{hostname}:{remote_dir}", local_dir]
+
+        try:
+            subprocess.run(scp_command, check=True)
+            log.info("Successfully pulled %s to %s", remote_dir, local_dir)
+        except FileNotFoundError:
+            log.error("The system scp client could not be found.")
+            raise SCPTransferError("scp client not found")
+        except subprocess.CalledProcessError as e:
+            log.error("scp exited with return code %s while pulling %s", e.returncode, remote_dir)
+            raise SCPTransferError(f"scp failed with return code {e.returncode}")
+
+
 class SSHHandler(SSHCommands, SCPFileTransfer):
     """
     SSHHandler Class:
 
     This class is used to handle SSH and SCP operations.
 
-    Initialise this class with hostname, username and SSH key. On initialisation the SSHHandler will automatically
-    connect to the target device.
+    Initialise this class with hostname, username and SSH key. On initialisation the SSHHandler will take a pooled
+    connection to the target device if one is available, otherwise it will automatically connect to it. Set
+    enable_compression to True to compress new connections, which suits text heavy transfers such as log files.
+
+    Use the SSHHandler as a context manager to hand the connection back when finished. On exit only the SCP session
+    is closed, the SSH session is returned to the connection pool with its transport still open.
 
     Usage:
     SSHHandler = SSHHandler(hostname="198.18.0.171", username="root", ssh_key_path="./axiom_rsa.key")
     SSHHandler.execute_command("reboot")
+
+    with SSHHandler(hostname="198.18.0.171", username="root", ssh_key_path="./axiom_rsa.key") as ssh:
+        ssh.execute_command("reboot")
     """
 
-    def __init__(self, hostname, ssh_key_path, username):
+    __slots__ = ()
+
+    def __init__(self, hostname, ssh_key_path, username, enable_compression=False):
         super().__init__()
 
-        self.ssh_connect(hostname, username, ssh_key_path)
+        self.enable_compression = enable_compression
+
+        if not self.ssh_reuse(hostname, username, ssh_key_path):
+            self.ssh_connect(hostname, username, ssh_key_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # A session left by a failed block or a failed SCP close may be in an unknown state, so it is closed instead of
+        # being returned to the pool. Close errors are logged by the disconnect functions and never raised from here,
+        # so they can't replace an exception raised in the block
+        reusable = exc_type is None
+
+        if self.scp_connection_status == 2:
+            try:
+                self.scp_disconnect()
+            except SCPConnectionError:
+                reusable = False
+                self.sftp_session = None
+                self.scp_session = None
+                self.scp_connection_status = 1
+
+        if self.ssh_connection_status == 2:
+            if reusable:
+                self.ssh_release()
+            else:
+                with suppress(SSHConnectionError):
+                    self.ssh_disconnect()
+
+
+# Pooled sessions outlive any one SSHHandler, so they are closed when the process exits
+atexit.register(SSHConnect.close_pool)